@@ -1,27 +1,56 @@
 import os
+import logging
 import pdfkit
-import base64
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, jsonify, render_template
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
 import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# SIMD base64 encoder when available, stdlib otherwise
+try:
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
 
 # Load environment variables
 load_dotenv()
 
+# Debug output is off unless LOG_LEVEL=DEBUG is set; unknown levels fall back to INFO
+_log_level = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+logging.basicConfig(level=_log_level if isinstance(_log_level, int) else logging.INFO)
+log = logging.getLogger(__name__)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson for request parsing and jsonify"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__, static_folder="static", template_folder="templates")
+app.json = OrjsonProvider(app)
 
 # wkhtmltopdf binary path
 WKHTMLTOPDF_PATH = "/usr/bin/wkhtmltopdf"
 config = pdfkit.configuration(wkhtmltopdf=WKHTMLTOPDF_PATH)
 
-# PDF options
+# PDF options (contract.html has no scripts, so no javascript-delay is needed)
 PDF_OPTIONS = {
     "enable-local-file-access": None,
     "load-error-handling": "ignore",
     "load-media-error-handling": "ignore",
     "no-stop-slow-scripts": None,
-    "javascript-delay": "8000",
     "disable-smart-shrinking": None
 }
 
@@ -31,60 +60,166 @@ GITHUB_REPO = os.getenv("GITHUB_REPO")  # e.g. "NilanjanSaha-K/ContractVault"
 GITHUB_BRANCH = os.getenv("GITHUB_BRANCH", "main")
 
 
+def _make_session(headers=None):
+    """Create a session that keeps pooled keep-alive connections and retries"""
+    session = requests.Session()
+    # Only retry failed connections and GETs; a resent PUT that already landed
+    # on GitHub would fail on the stale SHA
+    retries = Retry(total=3, read=0, backoff_factor=0.2, allowed_methods=frozenset({"GET"}))
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+# GitHub API calls carry the token; other downloads use a plain session
+GH_SESSION = _make_session({"Authorization": f"token {GITHUB_TOKEN}"})
+HTTP_SESSION = _make_session()
+
+# (connect, read) timeout in seconds per attempt. With connection retries a
+# single call can still take ~30 s; gunicorn's --timeout bounds a whole request.
+HTTP_TIMEOUT = (5, 10)
+
+# Last known blob SHA per uploaded file (LRU), so updates can skip the lookup GET.
+# Each gunicorn worker process keeps its own cache.
+SHA_CACHE_SIZE = 2048
+SHA_CACHE = OrderedDict()
+_sha_cache_lock = threading.Lock()
+
 
 
 
 
 
 
+
+# Read size for base64 streaming; a multiple of 3 so chunks encode without padding
+B64_CHUNK_SIZE = 57 * 1024
+
+
+def file_to_base64(path, prefix=b""):
+    """Base64-encode a file chunk by chunk without loading it whole"""
+    buf = bytearray(prefix)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(B64_CHUNK_SIZE), b""):
+            buf.extend(b64encode(chunk))
+    return buf.decode("ascii")
+
+
 def img_to_base64(path):
     """Convert local image file to base64 data URI"""
-    with open(path, "rb") as f:
-        return "data:image/png;base64," + base64.b64encode(f.read()).decode("utf-8")
+    return file_to_base64(path, prefix=b"data:image/png;base64,")
 
 
-def upload_to_github(file_path, file_name):
-    """Upload file to GitHub, overwrite if exists"""
-    print(f"--- Starting GitHub upload for {file_name} ---")
-    with open(file_path, "rb") as f:
-        content = base64.b64encode(f.read()).decode("utf-8")
+def local_sig_to_base64(sig):
+    """Inline a local signature file as base64; URLs and other values pass through"""
+    if not sig or not isinstance(sig, str):
+        return sig
+    try:
+        return img_to_base64(sig)
+    except (OSError, ValueError):
+        return sig
 
-    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{file_name}?t={int(time.time())}"  # Add timestamp to avoid caching issues
-    headers = {"Authorization": f"token {GITHUB_TOKEN}"} 
-
-    # --- Step 1: Check if file exists and get its SHA ---
-    sha = None
-    print(f"Checking for existing file at: {url}")
-    r = requests.get(url, headers=headers, params={"ref": GITHUB_BRANCH})
-    
-    print(f"GET request status code: {r.status_code}")
+
+# Logo is static, so encode it once at import
+_logo_path = os.path.join(app.static_folder, "logo.png")
+LOGO_DATA_URI = img_to_base64(_logo_path) if os.path.exists(_logo_path) else None
+
+
+def url_to_base64(url):
+    """Download remote image and convert it to base64 data URI"""
+    response = HTTP_SESSION.get(url, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return "data:image/png;base64," + b64encode(response.content).decode("ascii")
+
+
+def _get_cached_sha(file_name):
+    """Return the cached SHA for file_name, marking it recently used"""
+    with _sha_cache_lock:
+        sha = SHA_CACHE.get(file_name)
+        if sha:
+            SHA_CACHE.move_to_end(file_name)
+        return sha
+
+
+def _set_cached_sha(file_name, sha):
+    """Cache (or with sha=None, forget) the SHA for file_name, evicting the oldest entries"""
+    with _sha_cache_lock:
+        if sha is None:
+            SHA_CACHE.pop(file_name, None)
+            return
+        SHA_CACHE[file_name] = sha
+        SHA_CACHE.move_to_end(file_name)
+        while len(SHA_CACHE) > SHA_CACHE_SIZE:
+            SHA_CACHE.popitem(last=False)
+
+
+def _fetch_github_sha(url):
+    """Look up the SHA of an existing file on GitHub, or None if it doesn't exist"""
+    log.debug("Checking for existing file at: %s", url)
+    r = GH_SESSION.get(url, params={"ref": GITHUB_BRANCH}, timeout=HTTP_TIMEOUT)
+
+    log.debug("GET request status code: %s", r.status_code)
     if r.status_code == 200:
         sha = r.json().get("sha")
-        print(f"File exists. SHA received: {sha}")
-    else:
-        print("File does not exist or failed to fetch. Will attempt to create a new file.")
-        print(f"GET response body: {r.text}")
+        log.debug("File exists. SHA received: %s", sha)
+        return sha
+    log.debug("File does not exist or failed to fetch. Will attempt to create a new file.")
+    log.debug("GET response body: %s", r.text)
+    return None
+
 
+def upload_to_github(content_bytes, file_name, expect_existing=False):
+    """Upload file contents to GitHub, overwrite if exists.
+
+    Pass expect_existing=True when updating a file that should already be on
+    GitHub, so a SHA cache miss is resolved with a GET up front instead of a
+    PUT that is expected to fail.
+    """
+    log.debug("--- Starting GitHub upload for %s ---", file_name)
+    content = b64encode(content_bytes).decode("ascii")
+
+    url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{file_name}?t={int(time.time())}"  # Add timestamp to avoid caching issues
 
-    # --- Step 2: Prepare the payload for the PUT request ---
+    # --- Step 1: Prepare the payload, reusing the SHA from our last upload ---
     payload = {
         "message": f"Update contract {file_name}",
         "content": content,
         "branch": GITHUB_BRANCH
     }
+    sha = _get_cached_sha(file_name)
+    looked_up = False
+    if not sha and expect_existing:
+        sha = _fetch_github_sha(url)
+        looked_up = True
     if sha:
         payload["sha"] = sha # Add SHA to payload if we are updating
 
-    print(f"Preparing to send PUT request. Payload includes SHA: {'sha' in payload}")
+    log.debug("Preparing to send PUT request. Payload includes SHA: %s", "sha" in payload)
 
-    # --- Step 3: Send the PUT request to create or update the file ---
-    response = requests.put(url, headers=headers, json=payload)
-    
-    print(f"GitHub PUT response status: {response.status_code}")
-    print(f"GitHub PUT response body: {response.text}")
+    # --- Step 2: Send the PUT request to create or update the file ---
+    response = GH_SESSION.put(url, json=payload, timeout=HTTP_TIMEOUT)
+
+    log.debug("GitHub PUT response status: %s", response.status_code)
+
+    # --- Step 3: SHA missing or stale, look it up once and retry ---
+    if response.status_code in [409, 422] and not looked_up:
+        _set_cached_sha(file_name, None)
+        log.debug("SHA mismatch.")
+        sha = _fetch_github_sha(url)
+        if sha:
+            payload["sha"] = sha
+        else:
+            payload.pop("sha", None)
+
+        response = GH_SESSION.put(url, json=payload, timeout=HTTP_TIMEOUT)
+        log.debug("GitHub PUT retry response status: %s", response.status_code)
 
     if response.status_code in [200, 201]:
-        print("--- Upload successful! ---")
+        _set_cached_sha(file_name, response.json()["content"]["sha"])
+        log.debug("--- Upload successful! ---")
         return f"https://raw.githubusercontent.com/{GITHUB_REPO}/{GITHUB_BRANCH}/{file_name}"
     else:
         # Raise an exception with a more detailed error message
@@ -119,30 +254,23 @@ def create_contract():
         sig_user = body.get("signatureUser")
         sig_client = body.get("signatureClient")
 
-        if sig_user and os.path.exists(sig_user):
-            mapped_data["signatureUser"] = img_to_base64(sig_user)
-        else:
-            mapped_data["signatureUser"] = sig_user
-
-        if sig_client and os.path.exists(sig_client):
-            mapped_data["signatureClient"] = img_to_base64(sig_client)
-        else:
-            mapped_data["signatureClient"] = sig_client
+        mapped_data["signatureUser"] = local_sig_to_base64(sig_user)
+        mapped_data["signatureClient"] = local_sig_to_base64(sig_client)
 
         # Render HTML
         html = render_template("contract.html", **mapped_data)
 
-        # Save PDF locally
+        # Generate PDF in memory
         file_name = f"{mapped_data['contractId']}.pdf"
-        file_path = os.path.join(os.getcwd(), file_name)
-        pdfkit.from_string(html, file_path, configuration=config, options=PDF_OPTIONS)
+        pdf_bytes = pdfkit.from_string(html, False, configuration=config, options=PDF_OPTIONS)
 
         # Upload to GitHub
-        github_url = upload_to_github(file_path, file_name)
+        github_url = upload_to_github(pdf_bytes, file_name)
 
         return jsonify({"ok": True, "url": github_url})
 
     except Exception as e:
+        log.exception("An error occurred")
         return jsonify({"ok": False, "error": str(e)}), 500
 
 import time # Add this import at the top of your file
@@ -153,8 +281,8 @@ import time # Add this import at the top of your file
 def accept_contract():
     try:
         body = request.json
-        print("\n--- Received request for /isAccepted ---")
-        print(f"Client Signature URL from JSON: {body.get('signatureClient')}")
+        log.debug("--- Received request for /isAccepted ---")
+        log.debug("Client Signature URL from JSON: %s", body.get("signatureClient"))
 
         if not body.get("signatureClient"):
             return jsonify({"ok": False, "error": "Client signature is missing"}), 400
@@ -176,8 +304,7 @@ def accept_contract():
 
         # 2. Process logo and signatures reliably
         # Logo
-        logo_path = os.path.join(app.static_folder, "logo.png")
-        mapped_data["logo_base64"] = img_to_base64(logo_path) if os.path.exists(logo_path) else None
+        mapped_data["logo_base64"] = LOGO_DATA_URI
 
         # Signatures (with robust URL downloading)
         sig_user_url = body.get("signatureUser")
@@ -185,57 +312,49 @@ def accept_contract():
         mapped_data["signatureUser"] = None
         mapped_data["signatureClient"] = None
 
+        # Signatures sent inline as data URIs need no download
+        if sig_user_url and sig_user_url.startswith('data:image'):
+            mapped_data["signatureUser"] = sig_user_url
+        if sig_client_url and sig_client_url.startswith('data:image'):
+            mapped_data["signatureClient"] = sig_client_url
+
         try:
-            if sig_user_url and sig_user_url.startswith('http'):
-                response = requests.get(sig_user_url)
-                response.raise_for_status()
-                b64_img = base64.b64encode(response.content).decode("utf-8")
-                mapped_data["signatureUser"] = f"data:image/png;base64,{b64_img}"
-
-            if sig_client_url and sig_client_url.startswith('http'):
-                print(">>> Downloading Client Signature...")
-                response = requests.get(sig_client_url)
-                response.raise_for_status()
-                b64_img = base64.b64encode(response.content).decode("utf-8")
-                mapped_data["signatureClient"] = f"data:image/png;base64,{b64_img}"
-                print(">>> Client Signature processed successfully.")
+            # Download both signatures concurrently
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                fut_user = ex.submit(url_to_base64, sig_user_url) if sig_user_url and sig_user_url.startswith('http') else None
+                fut_client = ex.submit(url_to_base64, sig_client_url) if sig_client_url and sig_client_url.startswith('http') else None
+
+                if fut_user:
+                    mapped_data["signatureUser"] = fut_user.result()
+                if fut_client:
+                    log.debug(">>> Waiting for Client Signature download...")
+                    mapped_data["signatureClient"] = fut_client.result()
+                    log.debug(">>> Client Signature processed successfully.")
 
         except requests.exceptions.RequestException as e:
             return jsonify({"ok": False, "error": f"Failed to download signature image: {e}"}), 500
 
-        # 3. Render HTML and SAVE IT to a temporary file
+        # 3. Render HTML
         html = render_template("contract.html", **mapped_data)
         
         # --- DEBUGGING STEP: Check if the signature is in the HTML before PDF conversion ---
-        if mapped_data["signatureClient"]:
-             print(">>> VERIFICATION: Client signature IS IN the HTML string.")
-        else:
-             print(">>> VERIFICATION: Client signature IS NOT in the HTML string.")
+        log.debug(">>> VERIFICATION: Client signature %s in the HTML string.",
+                  "IS" if mapped_data["signatureClient"] else "IS NOT")
 
-        temp_html_path = f"temp_{mapped_data['contractId']}_{int(time.time())}.html"
-        with open(temp_html_path, "w", encoding="utf-8") as f:
-            f.write(html)
-
-        # 4. Generate the PDF from the temporary HTML FILE
+        # 4. Generate the PDF in memory, piping the HTML to wkhtmltopdf
         file_name = f"{mapped_data['contractId']}.pdf"
-        file_path = os.path.join(os.getcwd(), file_name)
-        print(f">>> Generating PDF from temporary file: {temp_html_path}")
-        pdfkit.from_file(temp_html_path, file_path, configuration=config, options=PDF_OPTIONS)
-
-        # 5. Clean up the temporary HTML file
-        os.remove(temp_html_path)
+        log.debug(">>> Generating PDF: %s", file_name)
+        pdf_bytes = pdfkit.from_string(html, False, configuration=config, options=PDF_OPTIONS)
 
-        # 6. Re-upload to GitHub
-        github_url = upload_to_github(file_path, file_name)
+        # 5. Re-upload to GitHub
+        github_url = upload_to_github(pdf_bytes, file_name, expect_existing=True)
 
         return jsonify({"ok": True, "message": "Contract accepted and updated.", "url": github_url})
 
     except Exception as e:
-        # Clean up temp file in case of an error
-        if 'temp_html_path' in locals() and os.path.exists(temp_html_path):
-            os.remove(temp_html_path)
-        print(f"An error occurred: {e}")
+        log.exception("An error occurred")
         return jsonify({"ok": False, "error": str(e)}), 500
 if __name__ == "__main__":
-    app.run(debug=True, port=8080)
+    # Local development only; production runs under gunicorn (see Procfile)
+    app.run(port=8080)  # Flask reads FLASK_DEBUG itself
 